@@ -1,27 +1,51 @@
+import contextlib
+import io
 import logging
-import os
+import secrets
+import signal
+import time
 import traceback
+import weakref
 from datetime import datetime, timedelta
 import asyncio
-import requests
-from aiogram import Bot, Dispatcher, types
+import json
+import aiohttp
+import orjson
+import tiktoken
+from hashlib import sha256
+try:
+    import uvloop
+except ImportError:  # uvloop does not support Windows
+    uvloop = None
+from cachetools import TTLCache
+from aiogram import Bot, Dispatcher, BaseMiddleware, F, types
 from aiogram.filters import Command
 from aiogram.types import Message, InlineKeyboardButton, LabeledPrice
-from aiogram.enums import ChatMemberStatus
+from aiogram.enums import ChatMemberStatus, ChatAction
+from aiogram.exceptions import TelegramRetryAfter
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
-from sqlalchemy.orm import sessionmaker, declarative_base
-from sqlalchemy import text, Column, Integer, String, Boolean, DateTime, ForeignKey, Text, select
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+from aiogram.methods import SendMessage, EditMessageText, SendInvoice
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import text, select, delete, update
 from openai import AsyncOpenAI
-import asyncpg
 from config import (
     BOT_TOKEN, OR_API_KEY, CHANNEL, CHANNEL_URL, DATABASE_URL, 
-    FREE_REQUESTS_PER_DAY, ADMIN_USER_ID, HF_API_KEY, MODEL, DB_PASSWORD,
-    DEFAULT_NOTIFICATION_MESSAGE
+    FREE_REQUESTS_PER_DAY, ADMIN_USER_ID, HF_API_KEY, MODEL, LLM_CONTEXT_TOKENS,
+    DEFAULT_NOTIFICATION_MESSAGE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET,
+    WEBAPP_HOST, WEBAPP_PORT
 )
 from typing import Optional
 from migrations import migrate_database
 from models import *
+from db import (
+    async_session, create_database_if_not_exists,
+    resolve_pk, create_user, check_user_limits, forget_premium,
+    get_chat_history, save_messages, forget_history, history_writer, drain_history
+)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -41,8 +65,49 @@ if not DATABASE_URL:
     logger.error("DATABASE_URL could not be constructed - check database settings")
     exit(1)
 
+class TokenBucket:
+    """Token bucket rate limiter for asyncio tasks"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+
+    async def acquire(self, n: float = 1):
+        """Take n tokens, sleeping until they are available"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        # Reserve tokens up front so concurrent callers queue behind each other
+        self.tokens -= n
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
+class OutgoingRateLimitMiddleware(BaseRequestMiddleware):
+    """Throttle outgoing messages to stay within Telegram's ~30 msg/s bot limit"""
+
+    limited_methods = (SendMessage, EditMessageText, SendInvoice)
+
+    def __init__(self, bucket: TokenBucket, max_in_flight: int = 25):
+        self.bucket = bucket
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+
+    async def __call__(self, make_request, bot, method):
+        if not isinstance(method, self.limited_methods):
+            return await make_request(bot, method)
+        await self.bucket.acquire()
+        async with self.in_flight:
+            return await make_request(bot, method)
+
 # Initialize bot and dispatcher
-bot = Bot(token=BOT_TOKEN)
+bot_session = AiohttpSession(
+    json_loads=orjson.loads,
+    json_dumps=lambda obj: orjson.dumps(obj).decode()
+)
+bot = Bot(token=BOT_TOKEN, session=bot_session)
+send_bucket = TokenBucket(rate=30, capacity=30)
+bot.session.middleware(OutgoingRateLimitMiddleware(send_bucket))
 router = Dispatcher()
 
 # Initialize OpenAI client
@@ -51,6 +116,9 @@ openai_client = AsyncOpenAI(
     base_url="https://openrouter.ai/api/v1"
 )
 
+# Shared HTTP session for outbound API calls (created in main())
+http_session: Optional[aiohttp.ClientSession] = None
+
 # Premium subscription settings
 PREMIUM_PLANS = {
     "month": {
@@ -84,137 +152,132 @@ PREMIUM_PLANS = {
     }
 }
 
-# Database setup
-engine = create_async_engine(DATABASE_URL)
-async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+# Static /help message
+HELP_TEXT = (
+    "🤖 <b>AI Assistant Bot</b>\n\n"
+    "I'm an AI-powered bot that can help you with various tasks:\n"
+    "• Answer your questions\n"
+    "• Process voice messages\n"
+    "• Help with text analysis\n"
+    "• And much more!\n\n"
+    "<b>Available Commands:</b>\n"
+    "• /start - Start the bot\n"
+    "• /help - Show this help message\n"
+    "• /status - Show your current status and limits\n"
+    "• /reset_my_limit - Reset your daily limit\n"
+    "• /premium - Get premium subscription\n"
+    "• /clear - Clear chat history\n"
+    "• /migrate - Apply database migrations (admin only)\n"
+    "• /reset_limits - Reset daily limits for all users (admin only)\n\n"
+    "<b>Free Usage:</b>\n"
+    "• 300 free requests per day\n"
+    "• Basic AI features\n\n"
+    "<b>Premium Features:</b>\n"
+    "• Unlimited requests\n"
+    "• Priority support\n"
+    "• Early access to new features\n\n"
+    "📧 <b>Support:</b>\n"
+    "If you have any questions or need help, contact us at:\n"
+    "tdallstr@gmail.com"
+)
 
-async def create_database_if_not_exists():
-    """Initialize database with migrations"""
-    max_retries = 5
-    retry_delay = 5  # seconds
-    
-    for attempt in range(max_retries):
-        try:
-            logger.info(f"Attempting to connect to database (attempt {attempt + 1}/{max_retries})")
-            # Mask password in logs
-            safe_url = DATABASE_URL
-            if DB_PASSWORD and DB_PASSWORD.strip():
-                safe_url = DATABASE_URL.replace(DB_PASSWORD, '***')
-            logger.info(f"Database URL: {safe_url}")
-            
-            async with async_session() as session:
-                # Test connection
-                await session.execute(text("SELECT 1"))
-                logger.info("Database connection successful")
-                
-                # Create tables
-                await session.execute(text("""
-                    CREATE TABLE IF NOT EXISTS users (
-                        id SERIAL PRIMARY KEY,
-                        user_id BIGINT UNIQUE NOT NULL,
-                        username VARCHAR,
-                        first_name VARCHAR,
-                        last_name VARCHAR,
-                        is_premium BOOLEAN DEFAULT FALSE,
-                        premium_until TIMESTAMP,
-                        requests_today INTEGER DEFAULT 0,
-                        last_request_date DATE
-                    )
-                """))
-                
-                await session.execute(text("""
-                    CREATE TABLE IF NOT EXISTS chat_messages (
-                        id SERIAL PRIMARY KEY,
-                        user_id INTEGER REFERENCES users(id),
-                        role VARCHAR,
-                        content TEXT,
-                        timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                """))
-                
-                await session.commit()
-                logger.info("Database tables created successfully")
-                
-                # Apply migrations
-                success = await migrate_database(session)
-                if success:
-                    logger.info("Database migrations applied successfully")
-                else:
-                    logger.error("Failed to apply database migrations")
-                    return False
-                    
-                return True
-                
-        except Exception as e:
-            logger.error(f"Database connection attempt {attempt + 1} failed: {e}")
-            if attempt < max_retries - 1:
-                logger.info(f"Retrying in {retry_delay} seconds...")
-                await asyncio.sleep(retry_delay)
-            else:
-                logger.error("All database connection attempts failed")
-                return False
-    
-    return False
+# Premium plans message, rendered once since PREMIUM_PLANS is static
+PREMIUM_TEXT = (
+    "🌟 <b>Premium Subscription</b>\n\n"
+    "Choose the plan that suits you best:\n\n"
+    + "".join(
+        f"<b>{plan['title']}</b>\n"
+        f"💰 Price: {plan['price']} Stars\n"
+        f"{plan['description']}\n\n"
+        for plan in PREMIUM_PLANS.values()
+    )
+    + "Click the button below to select a plan and proceed with payment."
+)
 
-async def get_chat_history(user_id: int, limit: int = 5) -> list:
-    """
-    Get recent chat history for a user (last 5 messages)
-    """
-    try:
-        async with async_session() as session:
-            # Get user
-            stmt = select(User).where(User.user_id == user_id)
-            result = await session.execute(stmt)
-            user = result.scalar_one_or_none()
-            
-            if not user:
-                return []
-            
-            # Get recent messages ordered by timestamp
-            stmt = select(ChatMessage)\
-                .where(ChatMessage.user_id == user.id)\
-                .order_by(ChatMessage.timestamp.desc())\
-                .limit(limit)
-            result = await session.execute(stmt)
-            messages = result.scalars().all()
-            
-            # Convert to OpenAI message format and reverse order
-            return [
-                {"role": msg.role, "content": msg.content}
-                for msg in reversed(messages)
-            ]
-    except Exception as e:
-        logger.error(f"Error getting chat history for user {user_id}: {e}")
-        return []
+def _build_premium_markup():
+    builder = InlineKeyboardBuilder()
+    for plan_id, plan in PREMIUM_PLANS.items():
+        builder.button(text=f"Buy {plan['title']}", callback_data=f"buy_premium:{plan_id}")
+    builder.adjust(1)
+    return builder.as_markup()
 
-async def save_message(user_id: int, role: str, content: str):
-    """
-    Save a message to chat history
-    """
+PREMIUM_MARKUP = _build_premium_markup()
+
+class DbSessionMiddleware(BaseMiddleware):
+    """Provide one database session per update to handlers as `session`"""
+
+    def __init__(self, session_pool):
+        self.session_pool = session_pool
+
+    async def __call__(self, handler, event, data):
+        async with self.session_pool() as session:
+            data["session"] = session
+            return await handler(event, data)
+
+router.update.middleware(DbSessionMiddleware(async_session))
+
+# LLM response cache: sha256(model, sampling params, messages) -> response text
+_resp_cache = TTLCache(maxsize=10_000, ttl=3600)
+LLM_TEMPERATURE = 0.7
+LLM_MAX_TOKENS = 1000
+STREAM_EDIT_INTERVAL = 0.5  # seconds between edits of a streamed reply
+HISTORY_TOKEN_BUDGET = 2000  # max tokens of chat history sent with a request
+
+_encoding = None
+
+def load_tokenizer():
+    """Load the tokenizer once at startup; OpenRouter model slugs fall back to cl100k_base"""
+    global _encoding
     try:
-        async with async_session() as session:
-            # Get user by telegram user_id, not database id
-            stmt = select(User).where(User.user_id == user_id)
-            result = await session.execute(stmt)
-            user = result.scalar_one_or_none()
-            
-            if not user:
-                logger.warning(f"User {user_id} not found when trying to save message")
-                return
-            
-            message = ChatMessage(
-                user_id=user.id,
-                role=role,
-                content=content
-            )
-            session.add(message)
-            await session.commit()
+        try:
+            _encoding = tiktoken.encoding_for_model(MODEL.split("/")[-1])
+        except KeyError:
+            _encoding = tiktoken.get_encoding("cl100k_base")
     except Exception as e:
-        logger.error(f"Error saving message for user {user_id}: {e}")
+        # tiktoken downloads its BPE files on first use; estimate instead if that fails
+        logger.error(f"Failed to load tokenizer, estimating history size by length: {e}")
+
+def count_tokens(text: str) -> int:
+    if _encoding is None:
+        return len(text) // 4 + 1
+    return len(_encoding.encode(text, disallowed_special=()))
+
+def completion_budget(messages: list) -> int:
+    """max_tokens for a request, shrunk when the prompt leaves less room in the context window"""
+    # ~4 tokens of per-message framing on top of the content
+    prompt_tokens = sum(count_tokens(m["content"]) + 4 for m in messages)
+    return max(128, min(LLM_MAX_TOKENS, LLM_CONTEXT_TOKENS - prompt_tokens - 32))
+
+def trim_history(chat_history: list, budget: int = HISTORY_TOKEN_BUDGET) -> list:
+    """Drop the oldest messages until the history fits into the token budget"""
+    sizes = [count_tokens(m["content"]) for m in chat_history]
+    total = sum(sizes)
+    start = 0
+    while start < len(chat_history) and total > budget:
+        total -= sizes[start]
+        start += 1
+    return chat_history[start:]
 
-async def get_chatgpt_response(message: str, chat_history: list) -> str:
+def _response_cache_key(messages: list) -> bytes:
+    """Build a deterministic cache key for a completion request"""
+    h = sha256()
+    for part in (MODEL, str(LLM_TEMPERATURE), str(LLM_MAX_TOKENS)):
+        h.update(part.encode())
+        h.update(b"\x00")
+    for m in messages:
+        h.update(m["role"].encode())
+        h.update(b"\x00")
+        h.update(m["content"].encode())
+        h.update(b"\x00")
+    return h.digest()
+
+async def get_chatgpt_response(message: str, chat_history: list, on_partial=None) -> str:
     """
     Get response from ChatGPT API with chat history
+
+    on_partial: optional coroutine function; when given the response is
+    streamed and on_partial is awaited with the text so far, at most every
+    STREAM_EDIT_INTERVAL seconds.
     """
     try:
         if not MODEL:
@@ -224,32 +287,105 @@ async def get_chatgpt_response(message: str, chat_history: list) -> str:
         # Prepare messages with history
         messages = [
             {"role": "system", "content": "You are a helpful AI assistant."},
-            *chat_history,
+            *trim_history(chat_history),
             {"role": "user", "content": message}
         ]
         
-        response = await openai_client.chat.completions.create(
-            model=MODEL,
-            messages=messages,
-            temperature=0.7,
-            max_tokens=1000
-        )
-        return response.choices[0].message.content
+        key = _response_cache_key(messages)
+        cached = _resp_cache.get(key)
+        if cached is not None:
+            return cached
+        
+        max_tokens = completion_budget(messages)
+        if on_partial is None:
+            response = await openai_client.chat.completions.create(
+                model=MODEL,
+                messages=messages,
+                temperature=LLM_TEMPERATURE,
+                max_tokens=max_tokens
+            )
+            content = response.choices[0].message.content
+        else:
+            stream = await openai_client.chat.completions.create(
+                model=MODEL,
+                messages=messages,
+                temperature=LLM_TEMPERATURE,
+                max_tokens=max_tokens,
+                stream=True
+            )
+            content = ""
+            last_update = time.monotonic()
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                content += chunk.choices[0].delta.content or ""
+                if content.strip() and time.monotonic() - last_update > STREAM_EDIT_INTERVAL:
+                    await on_partial(content)
+                    last_update = time.monotonic()
+        
+        if content:
+            _resp_cache[key] = content
+        return content
     except Exception as e:
         logger.error(f"Error getting ChatGPT response: {str(e)}")
         return "Sorry, I'm having trouble connecting to ChatGPT right now. Please try again later."
 
+async def answer_with_chatgpt(message: Message, text: str, chat_history: list) -> str:
+    """
+    Stream the ChatGPT reply into a single Telegram message and return its full text
+    """
+    reply = await message.answer("…")
+    shown = reply.text
+    
+    async def show(partial: str):
+        nonlocal shown
+        if partial == shown:
+            return
+        try:
+            await reply.edit_text(partial)
+            shown = partial
+        except Exception as e:
+            # A failed edit (flood control, deleted message, too long) must not stop generation
+            logger.error(f"Failed to edit streamed reply: {e}")
+    
+    response = await get_chatgpt_response(text, chat_history, on_partial=show)
+    if not response:
+        response = "Sorry, I couldn't generate a response. Please try again."
+    await show(response)
+    return response
+
+# Numeric id of CHANNEL, resolved once in main() to skip username lookups
+channel_id = None
+
+# Subscription status cache: user_id -> is_subscribed, bounded with TTL expiry
+_SUB_TTL = 300  # seconds
+_sub_cache = TTLCache(maxsize=100_000, ttl=_SUB_TTL)
+
 async def check_subscription(user_id: int) -> bool:
     """
     Check if user is subscribed to the channel
     """
+    if user_id in _sub_cache:
+        return _sub_cache[user_id]
+    
     try:
-        member = await bot.get_chat_member(chat_id=CHANNEL, user_id=user_id)
-        return member.status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR]
+        member = await bot.get_chat_member(chat_id=channel_id or CHANNEL, user_id=user_id)
+        is_subscribed = member.status in [ChatMemberStatus.MEMBER, ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR]
+        _sub_cache[user_id] = is_subscribed
+        return is_subscribed
     except Exception as e:
         logger.error(f"Error checking subscription: {str(e)}")
         return False
 
+async def send_typing(chat_id: int):
+    """
+    Show the typing indicator, ignoring failures
+    """
+    try:
+        await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+    except Exception as e:
+        logger.warning(f"Failed to send typing action to chat {chat_id}: {e}")
+
 async def send_subscription_message(message: Message):
     """
     Send subscription request message
@@ -270,24 +406,32 @@ async def send_subscription_message(message: Message):
         reply_markup=builder.as_markup()
     )
 
-@router.callback_query(lambda c: c.data == "check_subscription")
+@router.callback_query(F.data == "check_subscription")
 async def process_subscription_check(callback_query: types.CallbackQuery):
     """
     Handle subscription check button click
     """
+    # Drop cached status so a fresh subscription is picked up immediately
+    _sub_cache.pop(callback_query.from_user.id, None)
     if await check_subscription(callback_query.from_user.id):
         await callback_query.message.delete()
         await callback_query.answer("Thank you for subscribing! You can now use the bot.", show_alert=True)
     else:
         await callback_query.answer("You are not subscribed to the channel yet!", show_alert=True)
 
-async def get_user(session: AsyncSession, user_id: int) -> Optional[User]:
-    """Get user from database"""
-    result = await session.execute(select(User).where(User.user_id == user_id))
-    return result.scalar_one_or_none()
+# Per-user locks, dropped automatically once no handler holds or awaits them
+_user_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+def user_lock(user_id: int) -> asyncio.Lock:
+    """Get the lock serializing message handling for a user"""
+    lock = _user_locks.get(user_id)
+    if lock is None:
+        lock = asyncio.Lock()
+        _user_locks[user_id] = lock
+    return lock
 
 @router.message(Command("start"))
-async def cmd_start(message: Message):
+async def cmd_start(message: Message, session: AsyncSession):
     """Handle /start command"""
     try:
         if not message.from_user:
@@ -297,27 +441,9 @@ async def cmd_start(message: Message):
             
         logger.info(f"Start command received from user {message.from_user.id}")
         
-        # Get or create user
-        async with async_session() as session:
-            logger.info(f"Checking if user {message.from_user.id} exists in database")
-            user = await get_user(session, message.from_user.id)
-            
-            if not user:
-                logger.info(f"Creating new user {message.from_user.id}")
-                new_user = User(
-                    user_id=message.from_user.id,
-                    username=message.from_user.username or None,
-                    first_name=message.from_user.first_name or None,
-                    last_name=message.from_user.last_name or None,
-                    is_premium=False,
-                    requests_today=0,
-                    last_request_date=datetime.utcnow().date()
-                )
-                session.add(new_user)
-                await session.commit()
-                logger.info(f"Created new user: {new_user.user_id}")
-            else:
-                logger.info(f"User {message.from_user.id} already exists in database")
+        # Create user unless it already exists (single statement, safe against double /start)
+        await create_user(session, message.from_user)
+        await session.commit()
 
         # Send welcome message
         logger.info(f"Sending welcome message to user {message.from_user.id}")
@@ -338,26 +464,11 @@ async def cmd_start(message: Message):
         logger.error(f"Traceback: {traceback.format_exc()}")
         await message.answer("An error occurred. Please try again later.")
 
-@router.callback_query(lambda c: c.data == "show_premium_plans")
+@router.callback_query(F.data == "show_premium_plans")
 async def show_premium_plans(callback: types.CallbackQuery):
     """Show premium plans when Get Premium button is clicked"""
     try:
-        text = "🌟 <b>Premium Subscription</b>\n\n"
-        text += "Choose the plan that suits you best:\n\n"
-        
-        for plan_id, plan in PREMIUM_PLANS.items():
-            text += f"<b>{plan['title']}</b>\n"
-            text += f"💰 Price: {plan['price']} Stars\n"
-            text += f"{plan['description']}\n\n"
-        
-        text += "Click the button below to select a plan and proceed with payment."
-        
-        builder = InlineKeyboardBuilder()
-        for plan_id, plan in PREMIUM_PLANS.items():
-            builder.button(text=f"Buy {plan['title']}", callback_data=f"buy_premium:{plan_id}")
-        builder.adjust(1)
-        
-        await callback.message.edit_text(text, reply_markup=builder.as_markup())
+        await callback.message.edit_text(PREMIUM_TEXT, reply_markup=PREMIUM_MARKUP, parse_mode="HTML")
         await callback.answer()
     except Exception as e:
         logger.error(f"Error in show_premium_plans: {e}")
@@ -365,21 +476,20 @@ async def show_premium_plans(callback: types.CallbackQuery):
         await callback.answer()
 
 @router.message(Command("clear"))
-async def cmd_clear(message: Message):
+async def cmd_clear(message: Message, session: AsyncSession):
     """
     Clear chat history for the user
     """
     try:
         user_id = message.from_user.id
-        async with async_session() as session:
-            stmt = select(User).where(User.user_id == user_id)
-            result = await session.execute(stmt)
-            user = result.scalar_one_or_none()
-            
-            if user:
-                # Delete all messages for the user using SQL
-                await session.execute(text("DELETE FROM chat_messages WHERE user_id = :user_id"), {"user_id": user.id})
-                await session.commit()
+        user_pk = await resolve_pk(session, user_id)
+        if user_pk is not None:
+            # Let queued writes land first so they aren't inserted after the delete
+            await drain_history(timeout=10)
+            # Delete all messages for the user in a single statement
+            await session.execute(delete(ChatMessage).where(ChatMessage.user_id == user_pk))
+            await session.commit()
+            forget_history(user_pk)
         
         await message.answer("Chat history has been cleared!")
     except Exception as e:
@@ -390,27 +500,12 @@ async def cmd_clear(message: Message):
 async def cmd_premium(message: Message):
     """Handle premium subscription command"""
     try:
-        text = "🌟 <b>Premium Subscription</b>\n\n"
-        text += "Choose the plan that suits you best:\n\n"
-        
-        for plan_id, plan in PREMIUM_PLANS.items():
-            text += f"<b>{plan['title']}</b>\n"
-            text += f"💰 Price: {plan['price']} Stars\n"
-            text += f"{plan['description']}\n\n"
-        
-        text += "Click the button below to select a plan and proceed with payment."
-        
-        builder = InlineKeyboardBuilder()
-        for plan_id, plan in PREMIUM_PLANS.items():
-            builder.button(text=f"Buy {plan['title']}", callback_data=f"buy_premium:{plan_id}")
-        builder.adjust(1)
-        
-        await message.answer(text, reply_markup=builder.as_markup())
+        await message.answer(PREMIUM_TEXT, reply_markup=PREMIUM_MARKUP, parse_mode="HTML")
     except Exception as e:
         logger.error(f"Error in cmd_premium: {e}")
         await message.answer("An error occurred. Please try again later.")
 
-@router.callback_query(lambda c: c.data.startswith("buy_premium:"))
+@router.callback_query(F.data.startswith("buy_premium:"))
 async def process_buy_premium(callback: types.CallbackQuery):
     """Handle premium subscription purchase"""
     try:
@@ -447,107 +542,63 @@ async def process_pre_checkout_query(pre_checkout_query: types.PreCheckoutQuery)
         logger.error(f"Error in process_pre_checkout_query: {e}")
         await pre_checkout_query.answer(ok=False, error_message="An error occurred. Please try again later.")
 
-@router.message(lambda message: message.successful_payment)
-async def process_successful_payment(message: Message):
+@router.message(F.successful_payment)
+async def process_successful_payment(message: Message, session: AsyncSession):
     """Handle successful payment"""
     try:
         plan_id = message.successful_payment.invoice_payload.split(":")[1]
         plan = PREMIUM_PLANS[plan_id]
         
         # Update user's premium status
-        async with async_session() as session:
-            user = await get_user(session, message.from_user.id)
-            if user:
-                user.is_premium = True
-                user.premium_until = datetime.utcnow() + timedelta(days=plan["duration_days"])
-                await session.commit()
-                
-                await message.answer(
-                    f"✅ Thank you for purchasing Premium!\n\n"
-                    f"Your premium subscription is active until: {user.premium_until.strftime('%d.%m.%Y')}\n\n"
-                    f"You now have access to:\n"
-                    f"• Unlimited requests\n"
-                    f"• Priority support\n"
-                    f"• Early access to new features"
-                )
-            else:
-                await message.answer("❌ An error occurred while activating your premium subscription. Please contact support.")
+        premium_until = datetime.utcnow() + timedelta(days=plan["duration_days"])
+        result = await session.execute(
+            update(User)
+            .where(User.user_id == message.from_user.id)
+            .values(is_premium=True, premium_until=premium_until)
+            .returning(User.id)
+        )
+        if result.scalar_one_or_none() is not None:
+            await session.commit()
+            forget_premium(message.from_user.id)
+            
+            await message.answer(
+                f"✅ Thank you for purchasing Premium!\n\n"
+                f"Your premium subscription is active until: {premium_until.strftime('%d.%m.%Y')}\n\n"
+                f"You now have access to:\n"
+                f"• Unlimited requests\n"
+                f"• Priority support\n"
+                f"• Early access to new features"
+            )
+        else:
+            await message.answer("❌ An error occurred while activating your premium subscription. Please contact support.")
     except Exception as e:
         logger.error(f"Error in process_successful_payment: {e}")
         await message.answer("❌ An error occurred while activating your premium subscription. Please contact support.")
 
-async def check_user_limits(user_id: int) -> bool:
-    try:
-        # Check if user is admin
-        if user_id == ADMIN_USER_ID:
-            return True
-            
-        async with async_session() as session:
-            stmt = select(User).where(User.user_id == user_id)
-            result = await session.execute(stmt)
-            user = result.scalar_one_or_none()
-            
-            if not user:
-                logger.warning(f"User {user_id} not found when checking limits")
-                return False
-            
-            # Reset daily counter if it's a new day
-            current_date = datetime.utcnow().date()
-            
-            # Handle both datetime and date types for last_request_date
-            last_date = user.last_request_date
-            if isinstance(last_date, datetime):
-                last_date = last_date.date()
-            
-            if last_date is None or last_date < current_date:
-                user.requests_today = 0
-                user.last_request_date = current_date
-                await session.commit()
-            
-            # Check if user has premium and it's still valid
-            if user.is_premium and user.premium_until and user.premium_until > datetime.utcnow():
-                return True
-            elif user.is_premium and (not user.premium_until or user.premium_until <= datetime.utcnow()):
-                # Premium expired, reset status
-                user.is_premium = False
-                user.premium_until = None
-                await session.commit()
-            
-            if user.requests_today >= FREE_REQUESTS_PER_DAY:
-                logger.info(f"User {user_id} reached daily limit: {user.requests_today}/{FREE_REQUESTS_PER_DAY}")
-                return False
-            
-            user.requests_today += 1
-            user.last_request_date = current_date
-            await session.commit()
-            logger.info(f"User {user_id} request count updated: {user.requests_today}/{FREE_REQUESTS_PER_DAY}")
-            return True
-    except Exception as e:
-        logger.error(f"Error checking user limits for user {user_id}: {e}")
-        return False
-
-async def whisper_stt(audio_file_path: str) -> str:
+async def whisper_stt(audio_bytes: memoryview) -> str:
     logger.info("Request to whisper_stt")
     try:
         API_URL = "https://api-inference.huggingface.co/models/openai/whisper-large-v3-turbo"
         headers = {"Authorization": f"Bearer {HF_API_KEY}"}
         
-        # Read the audio file in binary mode
-        with open(audio_file_path, 'rb') as f:
-            audio_data = f.read()
-            
-        response = requests.post(API_URL, headers=headers, data=audio_data)
-        
-        # Log the response status and content for debugging
-        logger.info(f"Whisper API Response Status: {response.status_code}")
-        logger.info(f"Whisper API Response Content: {response.text[:200]}...")  # Log first 200 chars
+        async with http_session.post(
+            API_URL,
+            headers=headers,
+            data=audio_bytes,
+            timeout=aiohttp.ClientTimeout(total=60)
+        ) as response:
+            response_text = await response.text()
         
-        if response.status_code != 200:
-            logger.error(f"Whisper API Error: {response.text}")
-            return ""
+            # Log the response status and content for debugging
+            logger.info(f"Whisper API Response Status: {response.status}")
+            logger.info(f"Whisper API Response Content: {response_text[:200]}...")  # Log first 200 chars
+            
+            if response.status != 200:
+                logger.error(f"Whisper API Error: {response_text}")
+                return ""
             
         try:
-            result = response.json()
+            result = json.loads(response_text)
             if "text" in result:
                 return result["text"]
             else:
@@ -555,7 +606,7 @@ async def whisper_stt(audio_file_path: str) -> str:
                 return ""
         except ValueError as e:
             logger.error(f"Failed to parse API response as JSON: {e}")
-            logger.error(f"Raw response: {response.text}")
+            logger.error(f"Raw response: {response_text}")
             return ""
             
     except Exception as e:
@@ -565,88 +616,67 @@ async def whisper_stt(audio_file_path: str) -> str:
 @router.message(Command("help"))
 async def cmd_help(message: Message):
     """Handle /help command"""
-    help_text = (
-        "🤖 <b>AI Assistant Bot</b>\n\n"
-        "I'm an AI-powered bot that can help you with various tasks:\n"
-        "• Answer your questions\n"
-        "• Process voice messages\n"
-        "• Help with text analysis\n"
-        "• And much more!\n\n"
-        "<b>Available Commands:</b>\n"
-        "• /start - Start the bot\n"
-        "• /help - Show this help message\n"
-        "• /status - Show your current status and limits\n"
-        "• /reset_my_limit - Reset your daily limit\n"
-        "• /premium - Get premium subscription\n"
-        "• /clear - Clear chat history\n"
-        "• /migrate - Apply database migrations (admin only)\n"
-        "• /reset_limits - Reset daily limits for all users (admin only)\n\n"
-        "<b>Free Usage:</b>\n"
-        "• 300 free requests per day\n"
-        "• Basic AI features\n\n"
-        "<b>Premium Features:</b>\n"
-        "• Unlimited requests\n"
-        "• Priority support\n"
-        "• Early access to new features\n\n"
-        "📧 <b>Support:</b>\n"
-        "If you have any questions or need help, contact us at:\n"
-        "tdallstr@gmail.com"
-    )
-    
-    await message.answer(help_text, parse_mode="HTML")
+    await message.answer(HELP_TEXT, parse_mode="HTML")
 
 @router.message(Command("status"))
-async def cmd_status(message: Message):
+async def cmd_status(message: Message, session: AsyncSession):
     """Show user status and limits"""
     try:
-        async with async_session() as session:
-            user = await get_user(session, message.from_user.id)
-            if not user:
-                await message.answer("❌ User not found in database.")
-                return
-            
-            status_text = f"📊 <b>Your Status</b>\n\n"
-            status_text += f"👤 User ID: {user.user_id}\n"
-            status_text += f"📅 Last request date: {user.last_request_date}\n"
-            status_text += f"📝 Requests today: {user.requests_today}\n"
-            status_text += f"🎯 Daily limit: {FREE_REQUESTS_PER_DAY}\n"
-            status_text += f"💎 Premium: {'Yes' if user.is_premium else 'No'}\n"
-            
-            if user.is_premium and user.premium_until:
-                status_text += f"⏰ Premium until: {user.premium_until.strftime('%d.%m.%Y %H:%M')}\n"
-            
-            current_date = datetime.utcnow().date()
-            status_text += f"🗓️ Current date: {current_date}\n"
-            
-            await message.answer(status_text, parse_mode="HTML")
-            
+        result = await session.execute(
+            select(User.user_id, User.last_request_date, User.requests_today,
+                   User.is_premium, User.premium_until)
+            .where(User.user_id == message.from_user.id)
+        )
+        user = result.one_or_none()
+        if not user:
+            await message.answer("❌ User not found in database.")
+            return
+        
+        premium_line = ""
+        if user.is_premium and user.premium_until:
+            premium_line = f"⏰ Premium until: {user.premium_until.strftime('%d.%m.%Y %H:%M')}\n"
+        
+        status_text = (
+            f"📊 <b>Your Status</b>\n\n"
+            f"👤 User ID: {user.user_id}\n"
+            f"📅 Last request date: {user.last_request_date}\n"
+            f"📝 Requests today: {user.requests_today}\n"
+            f"🎯 Daily limit: {FREE_REQUESTS_PER_DAY}\n"
+            f"💎 Premium: {'Yes' if user.is_premium else 'No'}\n"
+            f"{premium_line}"
+            f"🗓️ Current date: {datetime.utcnow().date()}\n"
+        )
+        
+        await message.answer(status_text, parse_mode="HTML")
+        
     except Exception as e:
         logger.error(f"Error in status command: {e}")
         await message.answer("❌ An error occurred while getting status.")
 
 @router.message(Command("reset_my_limit"))
-async def cmd_reset_my_limit(message: Message):
+async def cmd_reset_my_limit(message: Message, session: AsyncSession):
     """Reset daily limit for current user"""
     try:
-        async with async_session() as session:
-            user = await get_user(session, message.from_user.id)
-            if not user:
-                await message.answer("❌ User not found in database.")
-                return
-            
-            user.requests_today = 0
-            user.last_request_date = datetime.utcnow().date()
-            await session.commit()
-            
-            await message.answer("✅ Your daily limit has been reset!")
-            logger.info(f"Daily limit reset for user {message.from_user.id}")
-            
+        result = await session.execute(
+            update(User)
+            .where(User.user_id == message.from_user.id)
+            .values(requests_today=0, last_request_date=datetime.utcnow().date())
+            .returning(User.id)
+        )
+        if result.scalar_one_or_none() is None:
+            await message.answer("❌ User not found in database.")
+            return
+        await session.commit()
+        
+        await message.answer("✅ Your daily limit has been reset!")
+        logger.info(f"Daily limit reset for user {message.from_user.id}")
+        
     except Exception as e:
         logger.error(f"Error in reset_my_limit command: {e}")
         await message.answer("❌ An error occurred while resetting your limit.")
 
 @router.message(Command("reset_limits"))
-async def cmd_reset_limits(message: Message):
+async def cmd_reset_limits(message: Message, session: AsyncSession):
     """Reset daily limits for all users (admin only)"""
     # Check if user is admin
     if message.from_user.id != ADMIN_USER_ID:
@@ -657,20 +687,19 @@ async def cmd_reset_limits(message: Message):
         # Send initial message
         status_message = await message.answer("🔄 Resetting daily limits for all users...")
         
-        async with async_session() as session:
-            # Reset requests_today for all users
-            await session.execute(text("UPDATE users SET requests_today = 0, last_request_date = CURRENT_DATE"))
-            await session.commit()
-            
-            await status_message.edit_text("✅ Daily limits have been reset for all users!")
-            logger.info("Daily limits reset by admin")
-            
+        # Reset requests_today for all users
+        await session.execute(text("UPDATE users SET requests_today = 0, last_request_date = CURRENT_DATE"))
+        await session.commit()
+        
+        await status_message.edit_text("✅ Daily limits have been reset for all users!")
+        logger.info("Daily limits reset by admin")
+        
     except Exception as e:
         logger.error(f"Error in reset_limits command: {e}")
         await message.answer("❌ An error occurred while resetting limits.")
 
 @router.message(Command("migrate"))
-async def cmd_migrate(message: Message):
+async def cmd_migrate(message: Message, session: AsyncSession):
     """Handle /migrate command"""
     # Check if user is admin
     if message.from_user.id != ADMIN_USER_ID:
@@ -681,23 +710,22 @@ async def cmd_migrate(message: Message):
         # Send initial message
         status_message = await message.answer("🔄 Applying database migrations...")
         
-        async with async_session() as session:
-            success = await migrate_database(session)
-            if success:
-                await status_message.edit_text("✅ Database migrations applied successfully!")
-                # Send additional notification to admin
-                await bot.send_message(
-                    ADMIN_USER_ID,
-                    "✅ Database migrations completed successfully!\n"
-                    "All tables and columns are up to date."
-                )
-            else:
-                await status_message.edit_text("❌ Error applying database migrations. Check logs for details.")
-                # Send error notification to admin
-                await bot.send_message(
-                    ADMIN_USER_ID,
-                    "❌ Database migration failed!\nCheck logs for details."
-                )
+        success = await migrate_database(session, bot)
+        if success:
+            await status_message.edit_text("✅ Database migrations applied successfully!")
+            # Send additional notification to admin
+            await bot.send_message(
+                ADMIN_USER_ID,
+                "✅ Database migrations completed successfully!\n"
+                "All tables and columns are up to date."
+            )
+        else:
+            await status_message.edit_text("❌ Error applying database migrations. Check logs for details.")
+            # Send error notification to admin
+            await bot.send_message(
+                ADMIN_USER_ID,
+                "❌ Database migration failed!\nCheck logs for details."
+            )
     except Exception as e:
         logger.error(f"Error in migrate command: {e}")
         await message.answer("❌ An error occurred while applying migrations.")
@@ -710,8 +738,88 @@ async def cmd_migrate(message: Message):
         except Exception as notify_error:
             logger.error(f"Failed to send admin notification: {notify_error}")
 
+BROADCAST_PAGE_SIZE = 1000
+BROADCAST_CONCURRENCY = 25
+BROADCAST_PROGRESS_INTERVAL = 1.0  # seconds; Telegram floods past ~1 edit/s
+
+async def _send_broadcast_message(user_id: int, text: str, sem: asyncio.Semaphore) -> bool:
+    async with sem:
+        for attempt in range(2):
+            try:
+                await bot.send_message(user_id, text)
+                return True
+            except TelegramRetryAfter as e:
+                if attempt:
+                    logger.error(f"Failed to send notification to user {user_id}: {e}")
+                    return False
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                logger.error(f"Failed to send notification to user {user_id}: {e}")
+                return False
+
+async def _report_broadcast_progress(status_message: Message, counts: dict):
+    """Edit the status message with the running counts at most once per interval"""
+    shown = None
+    while True:
+        await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+        current = (counts["sent"], counts["failed"])
+        if current == shown:
+            continue
+        try:
+            await status_message.edit_text(
+                f"🔄 Sending notifications...\n"
+                f"✅ Sent: {current[0]}\n"
+                f"❌ Failed: {current[1]}"
+            )
+            shown = current
+        except Exception as e:
+            logger.error(f"Failed to update broadcast progress: {e}")
+
+async def broadcast(session: AsyncSession, text: str, status_message: Optional[Message] = None) -> tuple:
+    """Send text to all users concurrently, returns (success_count, error_count)
+
+    Users are read in pages by primary key and the session's connection is
+    released while a page is being sent; the send rate itself is bounded by
+    OutgoingRateLimitMiddleware. When status_message is given it is edited
+    with the progress while the broadcast runs.
+    """
+    sem = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+    counts = {"sent": 0, "failed": 0}
+    
+    async def send(user_id: int):
+        if await _send_broadcast_message(user_id, text, sem):
+            counts["sent"] += 1
+        else:
+            counts["failed"] += 1
+    
+    progress_task = None
+    if status_message is not None:
+        progress_task = asyncio.create_task(_report_broadcast_progress(status_message, counts))
+    try:
+        last_pk = 0
+        while True:
+            result = await session.execute(
+                select(User.id, User.user_id)
+                .where(User.id > last_pk)
+                .order_by(User.id)
+                .limit(BROADCAST_PAGE_SIZE)
+            )
+            rows = result.all()
+            await session.commit()
+            if not rows:
+                break
+            last_pk = rows[-1].id
+            await asyncio.gather(*(send(row.user_id) for row in rows))
+    finally:
+        if progress_task:
+            progress_task.cancel()
+            # Wait for it so a late progress edit can't overwrite the summary
+            with contextlib.suppress(asyncio.CancelledError):
+                await progress_task
+    return counts["sent"], counts["failed"]
+
 @router.message(Command("notificate"))
-async def cmd_notificate(message: Message):
+async def cmd_notificate(message: Message, session: AsyncSession):
     """Send notification to all users (admin only)"""
     # Check if user is admin
     if message.from_user.id != ADMIN_USER_ID:
@@ -725,37 +833,19 @@ async def cmd_notificate(message: Message):
         # Use notification text from config
         text = DEFAULT_NOTIFICATION_MESSAGE
         
-        # Get all users from database
-        async with async_session() as session:
-            stmt = select(User)
-            result = await session.execute(stmt)
-            users = result.scalars().all()
-            
-            success_count = 0
-            error_count = 0
-            
-            for user in users:
-                try:
-                    await bot.send_message(user.user_id, text)
-                    success_count += 1
-                    # Small delay to avoid rate limiting
-                    await asyncio.sleep(0.1)
-                except Exception as e:
-                    error_count += 1
-                    logger.error(f"Failed to send notification to user {user.user_id}: {e}")
-                    continue
-            
-            # Update status message
-            await status_message.edit_text(
-                f"✅ Notifications sent successfully!\n"
-                f"📊 Statistics:\n"
-                f"✅ Successfully sent: {success_count}\n"
-                f"❌ Failed: {error_count}\n"
-                f"📝 Total users: {len(users)}"
-            )
-            
-            logger.info(f"Notification broadcast completed. Success: {success_count}, Errors: {error_count}")
-            
+        success_count, error_count = await broadcast(session, text, status_message)
+        
+        # Update status message
+        await status_message.edit_text(
+            f"✅ Notifications sent successfully!\n"
+            f"📊 Statistics:\n"
+            f"✅ Successfully sent: {success_count}\n"
+            f"❌ Failed: {error_count}\n"
+            f"📝 Total users: {success_count + error_count}"
+        )
+        
+        logger.info(f"Notification broadcast completed. Success: {success_count}, Errors: {error_count}")
+        
     except Exception as e:
         logger.error(f"Error in notificate command: {e}")
         await message.answer("❌ An error occurred while sending notifications.")
@@ -769,7 +859,7 @@ async def cmd_notificate(message: Message):
             logger.error(f"Failed to send admin notification: {notify_error}")
 
 @router.message(Command("notificate_custom"))
-async def cmd_notificate_custom(message: Message):
+async def cmd_notificate_custom(message: Message, session: AsyncSession):
     """Send custom notification to all users (admin only)"""
     # Check if user is admin
     if message.from_user.id != ADMIN_USER_ID:
@@ -797,38 +887,20 @@ async def cmd_notificate_custom(message: Message):
         # Send initial message
         status_message = await message.answer("🔄 Sending custom notifications to all users...")
         
-        # Get all users from database
-        async with async_session() as session:
-            stmt = select(User)
-            result = await session.execute(stmt)
-            users = result.scalars().all()
-            
-            success_count = 0
-            error_count = 0
-            
-            for user in users:
-                try:
-                    await bot.send_message(user.user_id, custom_text)
-                    success_count += 1
-                    # Small delay to avoid rate limiting
-                    await asyncio.sleep(0.1)
-                except Exception as e:
-                    error_count += 1
-                    logger.error(f"Failed to send custom notification to user {user.user_id}: {e}")
-                    continue
-            
-            # Update status message
-            await status_message.edit_text(
-                f"✅ Custom notifications sent successfully!\n"
-                f"📊 Statistics:\n"
-                f"✅ Successfully sent: {success_count}\n"
-                f"❌ Failed: {error_count}\n"
-                f"📝 Total users: {len(users)}\n\n"
-                f"📤 Message sent:\n{custom_text[:100]}{'...' if len(custom_text) > 100 else ''}"
-            )
-            
-            logger.info(f"Custom notification broadcast completed. Success: {success_count}, Errors: {error_count}")
-            
+        success_count, error_count = await broadcast(session, custom_text, status_message)
+        
+        # Update status message
+        await status_message.edit_text(
+            f"✅ Custom notifications sent successfully!\n"
+            f"📊 Statistics:\n"
+            f"✅ Successfully sent: {success_count}\n"
+            f"❌ Failed: {error_count}\n"
+            f"📝 Total users: {success_count + error_count}\n\n"
+            f"📤 Message sent:\n{custom_text[:100]}{'...' if len(custom_text) > 100 else ''}"
+        )
+        
+        logger.info(f"Custom notification broadcast completed. Success: {success_count}, Errors: {error_count}")
+        
     except Exception as e:
         logger.error(f"Error in notificate_custom command: {e}")
         await message.answer("❌ An error occurred while sending custom notifications.")
@@ -842,129 +914,173 @@ async def cmd_notificate_custom(message: Message):
             logger.error(f"Failed to send admin notification: {notify_error}")
 
 @router.message()
-async def handle_message(message: Message):
+async def handle_message(message: Message, session: AsyncSession):
     """Handle incoming messages"""
     try:
-        # Ensure user exists in database
-        async with async_session() as session:
-            user = await get_user(session, message.from_user.id)
-            if not user:
-                # Create user if doesn't exist
-                new_user = User(
-                    user_id=message.from_user.id,
-                    username=message.from_user.username or None,
-                    first_name=message.from_user.first_name or None,
-                    last_name=message.from_user.last_name or None,
-                    is_premium=False,
-                    requests_today=0,
-                    last_request_date=datetime.utcnow().date()
-                )
-                session.add(new_user)
+        # Process one message per user at a time so history and counters stay consistent
+        async with user_lock(message.from_user.id):
+            # Ensure user exists in database
+            user_pk = await resolve_pk(session, message.from_user.id)
+            if user_pk is None:
+                user_pk = await create_user(session, message.from_user)
                 await session.commit()
-                logger.info(f"Created new user: {new_user.user_id}")
 
-        # Check subscription
-        if not await check_subscription(message.from_user.id):
-            await send_subscription_message(message)
-            return
-
-        # Check user limits
-        if not await check_user_limits(message.from_user.id):
-            await message.answer(
-                "⚠️ You've reached your daily message limit.\n"
-                "Upgrade to Premium for unlimited access!\n"
-                "Use /premium to see available plans."
+            # Check subscription while fetching history and showing the typing indicator
+            is_subscribed, chat_history, _ = await asyncio.gather(
+                check_subscription(message.from_user.id),
+                get_chat_history(session, user_pk),
+                send_typing(message.chat.id)
             )
-            return
+            if not is_subscribed:
+                await send_subscription_message(message)
+                return
 
-        # Handle voice messages
-        if message.voice:
-            try:
-                # Create voice directory if it doesn't exist
-                os.makedirs('voice', exist_ok=True)
-                
-                # Get voice file info
-                voice = message.voice
-                file_id = voice.file_id
-                file = await bot.get_file(file_id)
-                
-                # Download voice file
-                voice_path = f"voice/{message.from_user.id}.ogg"
-                await bot.download_file(file.file_path, voice_path)
-                
-                # Convert voice to text using Whisper
-                text = await whisper_stt(voice_path)
+            # Check user limits
+            if not await check_user_limits(session, message.from_user.id):
+                await message.answer(
+                    "⚠️ You've reached your daily message limit.\n"
+                    "Upgrade to Premium for unlimited access!\n"
+                    "Use /premium to see available plans."
+                )
+                return
+
+            # Commit the counter now so the connection isn't held during API calls
+            await session.commit()
+
+            # Handle voice messages
+            if message.voice:
+                try:
+                    # Get voice file info
+                    voice = message.voice
+                    file_id = voice.file_id
+                    file = await bot.get_file(file_id)
                 
-                # Delete the voice file after processing
-                os.remove(voice_path)
+                    # Download voice file into memory
+                    buf = io.BytesIO()
+                    await bot.download_file(file.file_path, destination=buf)
                 
+                    # Convert voice to text using Whisper, uploading straight from the buffer
+                    text = await whisper_stt(buf.getbuffer())
+                except Exception as e:
+                    logger.error(f"Error processing voice message: {e}")
+                    await message.answer("Sorry, there was an error processing your voice message. Please try again.")
+                    return
+            
                 if not text:
                     await message.answer("Sorry, I couldn't understand the voice message. Please try again.")
                     return
-                
-                # Get chat history
-                chat_history = await get_chat_history(message.from_user.id)
-                
-                # Get response from ChatGPT
-                response = await get_chatgpt_response(text, chat_history)
-                
-                # Save messages to history
-                await save_message(message.from_user.id, "user", text)
-                await save_message(message.from_user.id, "assistant", response)
-                
-                # Send response
-                await message.answer(response)
-                
-            except Exception as e:
-                logger.error(f"Error processing voice message: {e}")
-                await message.answer("Sorry, there was an error processing your voice message. Please try again.")
+            # Process text messages
+            elif message.text:
+                text = message.text
+            else:
                 return
 
-        # Process text messages
-        if message.text:
-            # Get chat history
-            chat_history = await get_chat_history(message.from_user.id)
-            
-            # Get response from ChatGPT
-            response = await get_chatgpt_response(message.text, chat_history)
-            
+            # Stream response from ChatGPT
+            response = await answer_with_chatgpt(message, text, chat_history)
+        
             # Save messages to history
-            await save_message(message.from_user.id, "user", message.text)
-            await save_message(message.from_user.id, "assistant", response)
-            
-            # Send response
-            await message.answer(response)
+            await save_messages(user_pk, [("user", text), ("assistant", response)])
     except Exception as e:
         logger.error(f"Error processing message: {e}")
         await message.answer("Sorry, an error occurred while processing your message.")
 
+async def run_webhook():
+    """Receive updates pushed by Telegram to an aiohttp server instead of polling"""
+    # Without a secret anyone who finds the path could post forged updates
+    secret = WEBHOOK_SECRET
+    if not secret:
+        secret = secrets.token_urlsafe(32)
+        logger.warning("WEBHOOK_SECRET is not set, using a random secret for this run")
+    
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=router,
+        bot=bot,
+        secret_token=secret
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, router, bot=bot)
+    
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT).start()
+        await bot.set_webhook(
+            f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+            secret_token=secret,
+            max_connections=100,
+            allowed_updates=router.resolve_used_update_types()
+        )
+        logger.info(f"Webhook server listening on {WEBAPP_HOST}:{WEBAPP_PORT}{WEBHOOK_PATH}")
+        
+        # Return on SIGINT/SIGTERM so main() can flush history and close sessions
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:  # not supported on Windows
+                pass
+        await stop.wait()
+        logger.info("Webhook server stopping")
+    finally:
+        await runner.cleanup()
+
 async def main():
     """Main function"""
+    global http_session, channel_id
+    history_task = None
     try:
         logger.info("Starting AI Telegram Bot...")
         
         # Create database tables
-        db_initialized = await create_database_if_not_exists()
+        db_initialized = await create_database_if_not_exists(bot)
         if not db_initialized:
             logger.error("Failed to initialize database. Exiting.")
             return
         
         logger.info("Database initialized successfully")
+        
+        # Resolve the channel username to its numeric id once
+        try:
+            channel_id = (await bot.get_chat(CHANNEL)).id
+        except Exception as e:
+            logger.error(f"Failed to resolve channel {CHANNEL}: {e}")
+        
+        # Load the tokenizer off the event loop, it may download BPE files
+        await asyncio.to_thread(load_tokenizer)
+        
+        # Create shared HTTP session for outbound API calls
+        http_session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=100, limit_per_host=20, ttl_dns_cache=300)
+        )
+        
+        # Start the chat history writer
+        history_task = asyncio.create_task(history_writer())
+        
         logger.info("Bot is starting...")
         
-        # Start polling with retry on network errors
-        while True:
-            try:
-                await router.start_polling(bot)
-            except Exception as e:
-                logger.error(f"Error in polling: {e}")
-                await asyncio.sleep(5)  # Wait 5 seconds before retrying
-                continue
+        if WEBHOOK_URL:
+            await run_webhook()
+        else:
+            # Polling retries network errors itself with backoff; a webhook
+            # left over from webhook mode would make getUpdates fail
+            await bot.delete_webhook()
+            await router.start_polling(bot)
     except KeyboardInterrupt:
         logger.info("Bot stopped by user")
     except Exception as e:
         logger.error(f"Critical error in main: {e}")
         raise
+    finally:
+        if history_task:
+            # Let the writer drain queued messages before stopping it
+            await drain_history(timeout=10)
+            history_task.cancel()
+        if http_session:
+            await http_session.close()
 
 if __name__ == "__main__":
-    asyncio.run(main()) 
\ No newline at end of file
+    if uvloop:
+        uvloop.run(main())
+    else:
+        asyncio.run(main()) 
\ No newline at end of file
@@ -10,6 +10,7 @@ OR_API_KEY = os.getenv("OR_API_KEY")
 HF_API_KEY = os.getenv("HF_API_KEY")
 DS_API_KEY = os.getenv("DS_API")
 MODEL = os.getenv("MODEL")
+LLM_CONTEXT_TOKENS = int(os.getenv("LLM_CONTEXT_TOKENS", "8192"))  # Context window of MODEL in tokens
 
 ADMIN_USER_ID = int(os.getenv("ADMIN_USER_ID", "0"))
 ADMIN_IDS = list(map(int, os.getenv("ADMIN_IDS", "").split(","))) if os.getenv("ADMIN_IDS") else []
@@ -26,6 +27,21 @@ DB_PORT = os.getenv("DB_PORT", "5432")
 # Use asyncpg driver for async database operations
 DATABASE_URL = f"postgresql+asyncpg://{DB_USER}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
 
+# Connection pool settings
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "30"))
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "10"))  # Connections opened at startup
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = int(os.getenv("DB_POOL_TIMEOUT", "10"))  # Seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))  # Seconds before a connection is replaced
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))  # Set to 0 behind PgBouncer transaction pooling
+
+# Webhook settings (long polling is used when WEBHOOK_URL is empty)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # Public HTTPS base URL, e.g. https://bot.example.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/tg")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")  # Random per run when empty
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
+
 # Application settings
 FREE_REQUESTS_PER_DAY = int(os.getenv("FREE_REQUESTS_PER_DAY", "30"))  # Default to 30 free requests per day
 TRIAL_PERIOD_DAYS = int(os.getenv("TRIAL_PERIOD_DAYS", "5"))  # Duration of trial period in days
@@ -0,0 +1,275 @@
+import asyncio
+import logging
+from collections import deque
+from datetime import datetime
+from typing import Optional
+from cachetools import TTLCache, LRUCache
+from aiogram import Bot
+from aiogram.types import User as TelegramUser
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy import text, select, insert
+from config import (
+    DATABASE_URL, DB_PASSWORD, FREE_REQUESTS_PER_DAY, ADMIN_USER_ID,
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE,
+    DB_STATEMENT_CACHE_SIZE, DB_POOL_MIN_SIZE
+)
+from migrations import migrate_database
+from models import User, ChatMessage, ROLE_NAMES, ROLE_CODES
+
+logger = logging.getLogger(__name__)
+
+# Database setup
+engine = create_async_engine(
+    DATABASE_URL,
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=True,
+    connect_args={
+        "server_settings": {"jit": "off"},
+        # SQLAlchemy prepares statements itself and keeps them per connection
+        "prepared_statement_cache_size": DB_STATEMENT_CACHE_SIZE,
+        "statement_cache_size": DB_STATEMENT_CACHE_SIZE
+    }
+)
+async_session = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+async def warm_up_pool(size: int):
+    """Open pool connections up front so the first updates don't pay connection setup"""
+    conns = [engine.connect() for _ in range(min(size, DB_POOL_SIZE))]
+    results = await asyncio.gather(*(conn.start() for conn in conns), return_exceptions=True)
+    for conn, result in zip(conns, results):
+        if isinstance(result, BaseException):
+            # Best effort: the pool opens connections on demand anyway
+            logger.error(f"Failed to open warm-up database connection: {result}")
+            continue
+        # Closing returns the connection to the pool
+        try:
+            await conn.close()
+        except Exception as e:
+            logger.error(f"Failed to release warm-up database connection: {e}")
+
+async def create_database_if_not_exists(bot: Bot):
+    """Initialize database with migrations, reporting the result to the admin via bot"""
+    max_retries = 5
+    retry_delay = 5  # seconds
+    
+    for attempt in range(max_retries):
+        try:
+            logger.info(f"Attempting to connect to database (attempt {attempt + 1}/{max_retries})")
+            # Mask password in logs
+            safe_url = DATABASE_URL
+            if DB_PASSWORD and DB_PASSWORD.strip():
+                safe_url = DATABASE_URL.replace(DB_PASSWORD, '***')
+            logger.info(f"Database URL: {safe_url}")
+
+            # Check connectivity first: migrate_database swallows its own errors
+            async with engine.connect() as conn:
+                await conn.execute(text("SELECT 1"))
+
+            # Create tables and apply migrations
+            async with async_session() as session:
+                success = await migrate_database(session, bot)
+            if success:
+                logger.info("Database migrations applied successfully")
+                break
+            else:
+                logger.error("Failed to apply database migrations")
+                return False
+                
+        except Exception as e:
+            logger.error(f"Database connection attempt {attempt + 1} failed: {e}")
+            if attempt < max_retries - 1:
+                logger.info(f"Retrying in {retry_delay} seconds...")
+                await asyncio.sleep(retry_delay)
+            else:
+                logger.error("All database connection attempts failed")
+                return False
+    
+    await warm_up_pool(DB_POOL_MIN_SIZE)
+    return True
+
+HISTORY_LIMIT = 5
+
+# users.id -> deque of the last HISTORY_LIMIT messages, kept in step with save_messages
+_history_cache = LRUCache(maxsize=10_000)
+
+async def get_chat_history(session: AsyncSession, user_pk: int, limit: int = HISTORY_LIMIT) -> list:
+    """
+    Get recent chat history for a user (last 5 messages)
+    """
+    if limit == HISTORY_LIMIT and user_pk in _history_cache:
+        return list(_history_cache[user_pk])
+    try:
+        # Get recent messages ordered by timestamp
+        stmt = select(ChatMessage.role, ChatMessage.content)\
+            .where(ChatMessage.user_id == user_pk)\
+            .order_by(ChatMessage.timestamp.desc(), ChatMessage.id.desc())\
+            .limit(limit)
+        rows = (await session.execute(stmt)).all()
+        
+        # Convert to OpenAI message format and reverse order
+        history = [
+            {"role": ROLE_NAMES[role], "content": content}
+            for role, content in reversed(rows)
+        ]
+        if limit == HISTORY_LIMIT:
+            _history_cache[user_pk] = deque(history, maxlen=HISTORY_LIMIT)
+        return history
+    except Exception as e:
+        logger.error(f"Error getting chat history for user {user_pk}: {e}")
+        return []
+
+# Chat history write-behind queue, drained in batches by history_writer()
+_history_q: asyncio.Queue = asyncio.Queue(maxsize=10_000)
+HISTORY_BATCH_SIZE = 100
+
+async def save_messages(user_pk: int, messages: list):
+    """
+    Queue (role, content) pairs for saving to chat history
+    """
+    cached = _history_cache.get(user_pk)
+    for role, content in messages:
+        if cached is not None:
+            cached.append({"role": role, "content": content})
+        await _history_q.put({
+            "user_id": user_pk,
+            "role": ROLE_CODES[role],
+            "content": content,
+            "timestamp": datetime.utcnow()
+        })
+
+def forget_history(user_pk: int):
+    """Drop the cached history of a user after their messages were deleted"""
+    _history_cache.pop(user_pk, None)
+
+async def write_history_batch(batch: list):
+    """
+    Insert a batch of queued chat messages in one transaction
+    """
+    try:
+        async with async_session() as session:
+            await session.execute(insert(ChatMessage), batch)
+            await session.commit()
+    except Exception as e:
+        logger.error(f"Error saving {len(batch)} chat messages: {e}")
+
+async def history_writer():
+    """
+    Background task persisting queued chat messages
+    """
+    while True:
+        batch = [await _history_q.get()]
+        try:
+            while len(batch) < HISTORY_BATCH_SIZE:
+                batch.append(_history_q.get_nowait())
+        except asyncio.QueueEmpty:
+            pass
+        await write_history_batch(batch)
+        for _ in batch:
+            _history_q.task_done()
+
+async def drain_history(timeout: float):
+    """Wait until queued chat messages are written, up to timeout seconds"""
+    try:
+        await asyncio.wait_for(_history_q.join(), timeout=timeout)
+    except asyncio.TimeoutError:
+        logger.error(f"{_history_q.qsize()} chat messages still unsaved after {timeout}s")
+
+# Telegram user_id -> users.id, the mapping never changes once a user exists
+_user_pk = TTLCache(maxsize=100_000, ttl=86400)
+
+async def resolve_pk(session: AsyncSession, user_id: int) -> Optional[int]:
+    """Get the database id for a Telegram user id, using the in-process cache"""
+    pk = _user_pk.get(user_id)
+    if pk is None:
+        result = await session.execute(select(User.id).where(User.user_id == user_id))
+        pk = result.scalar_one_or_none()
+        if pk is not None:
+            _user_pk[user_id] = pk
+    return pk
+
+async def create_user(session: AsyncSession, from_user: TelegramUser) -> int:
+    """Insert a user if missing and return its database id; the caller commits"""
+    stmt = pg_insert(User).values(
+        user_id=from_user.id,
+        username=from_user.username or None,
+        first_name=from_user.first_name or None,
+        last_name=from_user.last_name or None,
+        is_premium=False,
+        requests_today=0,
+        last_request_date=datetime.utcnow().date()
+    ).on_conflict_do_nothing(index_elements=[User.user_id]).returning(User.id)
+    pk = (await session.execute(stmt)).scalar_one_or_none()
+    if pk is None:
+        # Created concurrently by another update
+        return await resolve_pk(session, from_user.id)
+    logger.info(f"Created new user: {from_user.id}")
+    _user_pk[from_user.id] = pk
+    return pk
+
+# Premium expiry of recently seen premium users, lets them skip the counter UPDATE
+_premium_cache = TTLCache(maxsize=50_000, ttl=300)
+
+async def check_user_limits(session: AsyncSession, user_id: int) -> bool:
+    """Check and count a request against the daily limit; the caller commits"""
+    try:
+        # Check if user is admin
+        if user_id == ADMIN_USER_ID:
+            return True
+        
+        premium_until = _premium_cache.get(user_id)
+        if premium_until and premium_until > datetime.utcnow():
+            return True
+        
+        # Reset the counter on a new day, expire stale premium and count the
+        # request in one atomic statement; no row means the limit is reached.
+        # Requests of valid premium users are not counted.
+        result = await session.execute(text("""
+            UPDATE users SET
+                requests_today = CASE
+                    WHEN is_premium AND premium_until > :now THEN requests_today
+                    WHEN last_request_date IS NULL OR last_request_date < :today THEN 1
+                    ELSE requests_today + 1
+                END,
+                last_request_date = CASE
+                    WHEN is_premium AND premium_until > :now THEN last_request_date
+                    ELSE :today
+                END,
+                is_premium = is_premium AND COALESCE(premium_until > :now, FALSE),
+                premium_until = CASE WHEN premium_until > :now THEN premium_until END
+            WHERE user_id = :user_id
+              AND (
+                  (is_premium AND premium_until > :now)
+                  OR last_request_date IS NULL
+                  OR last_request_date < :today
+                  OR requests_today < :limit
+              )
+            RETURNING is_premium, premium_until, requests_today
+        """), {
+            "user_id": user_id,
+            "today": datetime.utcnow().date(),
+            "now": datetime.utcnow(),
+            "limit": FREE_REQUESTS_PER_DAY
+        })
+        row = result.one_or_none()
+        
+        if row is None:
+            logger.info(f"User {user_id} reached daily limit or not found")
+            return False
+        
+        if row.is_premium:
+            _premium_cache[user_id] = row.premium_until
+        else:
+            logger.info(f"User {user_id} request count updated: {row.requests_today}/{FREE_REQUESTS_PER_DAY}")
+        return True
+    except Exception as e:
+        logger.error(f"Error checking user limits for user {user_id}: {e}")
+        return False
+
+def forget_premium(user_id: int):
+    """Drop a cached premium expiry after the user's premium status changed"""
+    _premium_cache.pop(user_id, None)
@@ -1,84 +1,58 @@
 from sqlalchemy import text, inspect, MetaData, Table, Column
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.ext.asyncio import AsyncSession
+from aiogram import Bot
+from sqlalchemy.schema import CreateColumn
 import logging
-from models import Base, User, ChatMessage
+from models import Base, User, ChatMessage, ROLE_USER, ROLE_ASSISTANT
 from config import ADMIN_USER_ID
-import asyncio
 
 logger = logging.getLogger(__name__)
 
-async def get_table_columns(session: AsyncSession, table_name: str) -> list:
-    """Get list of existing columns in the database table"""
+async def get_table_columns(session: AsyncSession, table_names: list) -> dict:
+    """Get existing columns of the given tables as {table: {column: data_type}}"""
+    columns = {name: {} for name in table_names}
     try:
-        result = await session.execute(text(f"""
-            SELECT column_name 
+        result = await session.execute(text("""
+            SELECT table_name, column_name, data_type 
             FROM information_schema.columns 
-            WHERE table_name = '{table_name}'
-        """))
-        return [row[0] for row in result]
+            WHERE table_schema = current_schema() AND table_name = ANY(:names)
+        """), {"names": list(table_names)})
+        for table_name, column_name, data_type in result:
+            columns[table_name][column_name] = data_type
     except Exception as e:
-        logger.error(f"Error getting columns for table {table_name}: {e}")
-        return []
+        logger.error(f"Error getting columns for tables {table_names}: {e}")
+    return columns
 
-def get_model_columns(table_name: str) -> list:
-    """Get list of columns from the model"""
-    if table_name == 'users':
-        return [c.name for c in User.__table__.columns]
-    elif table_name == 'chat_messages':
-        return [c.name for c in ChatMessage.__table__.columns]
-    return []
+def add_columns_ddl(table: Table, db_columns: dict) -> str:
+    """Build one ALTER TABLE adding the model columns missing from the database"""
+    additions = [
+        f"ADD COLUMN IF NOT EXISTS {CreateColumn(c).compile(dialect=postgresql.dialect())}"
+        for c in table.columns if c.name not in db_columns
+    ]
+    if not additions:
+        return ""
+    return f"ALTER TABLE {table.name} " + ", ".join(additions)
 
-async def notify_admin(message: str):
+async def notify_admin(bot: Bot, message: str):
     """Send notification to admin"""
     try:
-        # Import bot locally to avoid circular import
-        import importlib
-        bot_module = importlib.import_module('bot')
-        bot = bot_module.bot
-        
-        # Ensure we're in an async context
-        if asyncio.get_event_loop().is_running():
-            await bot.send_message(ADMIN_USER_ID, message)
-        else:
-            logger.warning("Cannot send admin notification: not in async context")
+        await bot.send_message(ADMIN_USER_ID, message)
     except Exception as e:
         logger.error(f"Failed to send admin notification: {e}")
 
-async def migrate_database(session: AsyncSession):
+async def migrate_database(session: AsyncSession, bot: Bot):
     """Apply database migrations"""
     try:
-        # Create tables if they don't exist
-        await session.execute(text("""
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT UNIQUE NOT NULL,
-                username VARCHAR,
-                first_name VARCHAR,
-                last_name VARCHAR,
-                is_premium BOOLEAN DEFAULT FALSE,
-                premium_until TIMESTAMP,
-                requests_today INTEGER DEFAULT 0,
-                last_request_date DATE
-            )
-        """))
+        # Create tables that don't exist yet from the models
+        await session.run_sync(lambda sync_session: Base.metadata.create_all(sync_session.connection()))
         
-        await session.execute(text("""
-            CREATE TABLE IF NOT EXISTS chat_messages (
-                id SERIAL PRIMARY KEY,
-                user_id INTEGER REFERENCES users(id),
-                role VARCHAR,
-                content TEXT,
-                timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """))
+        # Read the current columns of both tables in one query
+        tables = (User.__table__, ChatMessage.__table__)
+        db_columns = await get_table_columns(session, [t.name for t in tables])
         
         # Check if user_id column needs to be migrated from INTEGER to BIGINT
-        result = await session.execute(text("""
-            SELECT data_type 
-            FROM information_schema.columns 
-            WHERE table_name = 'users' AND column_name = 'user_id'
-        """))
-        current_type = result.scalar_one_or_none()
+        current_type = db_columns['users'].get('user_id')
         
         if current_type == 'integer':
             logger.info("Migrating user_id column from INTEGER to BIGINT...")
@@ -92,33 +66,35 @@ async def migrate_database(session: AsyncSession):
         else:
             logger.warning(f"Unexpected user_id column type: {current_type}")
         
-        # Process users table
-        db_columns = await get_table_columns(session, 'users')
-        model_columns = get_model_columns('users')
-        missing_columns = [col for col in model_columns if col not in db_columns]
-        
-        for column in missing_columns:
-            column_type = next(c.type for c in User.__table__.columns if c.name == column)
+        # Check if role column needs to be migrated from VARCHAR to SMALLINT codes
+        if db_columns['chat_messages'].get('role') == 'character varying':
+            logger.info("Migrating chat_messages.role column from VARCHAR to SMALLINT...")
             await session.execute(text(f"""
-                ALTER TABLE users ADD COLUMN IF NOT EXISTS {column} {column_type}
+                ALTER TABLE chat_messages ALTER COLUMN role TYPE SMALLINT
+                USING CASE role WHEN 'user' THEN {ROLE_USER} WHEN 'assistant' THEN {ROLE_ASSISTANT} END
             """))
+            logger.info("Successfully migrated chat_messages.role column to SMALLINT")
         
-        # Process chat_messages table
-        db_columns = await get_table_columns(session, 'chat_messages')
-        model_columns = get_model_columns('chat_messages')
-        missing_columns = [col for col in model_columns if col not in db_columns]
+        # Add columns that exist in the models but not in the database
+        for table in tables:
+            ddl = add_columns_ddl(table, db_columns[table.name])
+            if ddl:
+                await session.execute(text(ddl))
         
-        for column in missing_columns:
-            column_type = next(c.type for c in ChatMessage.__table__.columns if c.name == column)
-            await session.execute(text(f"""
-                ALTER TABLE chat_messages ADD COLUMN IF NOT EXISTS {column} {column_type}
-            """))
+        # Index for fetching the latest messages of a user; it covers the
+        # full ORDER BY of get_chat_history so no sort step is needed
+        await session.execute(text("""
+            CREATE INDEX IF NOT EXISTS ix_chat_messages_user_ts_id
+            ON chat_messages (user_id, timestamp DESC, id DESC)
+        """))
+        await session.execute(text("DROP INDEX IF EXISTS ix_chat_messages_user_ts"))
         
         await session.commit()
         logger.info("Database migrations applied successfully")
         
         # Notify admin about successful migration
         await notify_admin(
+            bot,
             "✅ Database migrations completed successfully!\n"
             "All tables and columns are up to date."
         )
@@ -129,6 +105,6 @@ async def migrate_database(session: AsyncSession):
         logger.error(f"Error applying migrations: {e}")
         
         # Notify admin about migration failure
-        await notify_admin(f"❌ Database migration failed!\nError: {str(e)}")
+        await notify_admin(bot, f"❌ Database migration failed!\nError: {str(e)}")
         
         return False 
\ No newline at end of file
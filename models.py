@@ -1,9 +1,15 @@
 from datetime import datetime
 from sqlalchemy.orm import sessionmaker, declarative_base, relationship
-from sqlalchemy import Column, Integer, BigInteger, String, Boolean, DateTime, ForeignKey, Text, Date
+from sqlalchemy import Column, Integer, BigInteger, SmallInteger, String, Boolean, DateTime, ForeignKey, Text, Date, Index, text
 
 Base = declarative_base()
 
+# Codes stored in chat_messages.role
+ROLE_USER = 0
+ROLE_ASSISTANT = 1
+ROLE_NAMES = {ROLE_USER: "user", ROLE_ASSISTANT: "assistant"}
+ROLE_CODES = {name: code for code, name in ROLE_NAMES.items()}
+
 class User(Base):
     __tablename__ = "users"
 
@@ -12,9 +18,9 @@ class User(Base):
     username = Column(String, nullable=True)
     first_name = Column(String, nullable=True)
     last_name = Column(String, nullable=True)
-    is_premium = Column(Boolean, default=False)
+    is_premium = Column(Boolean, default=False, server_default=text("false"))
     premium_until = Column(DateTime, nullable=True)
-    requests_today = Column(Integer, default=0)
+    requests_today = Column(Integer, default=0, server_default=text("0"))
     last_request_date = Column(Date, nullable=True)
 
     # Relationship with chat messages
@@ -37,9 +43,14 @@ class ChatMessage(Base):
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"))
-    role = Column(String)  # 'user' or 'assistant'
+    role = Column(SmallInteger)  # ROLE_USER or ROLE_ASSISTANT
     content = Column(Text)
-    timestamp = Column(DateTime, default=datetime.utcnow)
+    timestamp = Column(DateTime, default=datetime.utcnow, server_default=text("CURRENT_TIMESTAMP"))
 
     # Relationship with user
     user = relationship("User", back_populates="messages")
+
+    # Latest messages of a user are read on every chat turn
+    __table_args__ = (
+        Index("ix_chat_messages_user_ts_id", user_id, timestamp.desc(), id.desc()),
+    )